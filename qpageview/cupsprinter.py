@@ -69,13 +69,61 @@ To print a list of files in one job, use `printFiles()`.
 
 """
 
+import functools
 import os
 import shutil
 import subprocess
+import time
 
-from PyQt6.QtGui import QPageSize
+from PyQt6.QtGui import QPageLayout, QPageSize
 from PyQt6.QtPrintSupport import QPrintEngine, QPrinter
 
+try:
+    import cups
+except ImportError:
+    cups = None
+
+
+# The (server, port, user) keys of CUPS servers that do not support
+# multi-document jobs, for which files are printed one by one using
+# printFile() right away.
+_printFilesUnsupported = set()
+
+# Cached connections to CUPS servers, see _connection().
+_connections = {}
+
+#: How long (in seconds) the list of printer names of a CUPS server is reused.
+connectionTimeout = 30
+
+# When handle() found no way to print, the time it did so, see handle().
+_noHandle = {}
+
+#: How long (in seconds) handle() remembers that no handle was available.
+noHandleTimeout = 10
+
+# The IPP status codes of printFiles() that make us fall back to printFile().
+_printFilesErrors = frozenset(getattr(cups, name)
+    for name in ('IPP_BAD_REQUEST', 'IPP_ATTRIBUTES',
+                 'IPP_OPERATION_NOT_SUPPORTED', 'IPP_INTERNAL_ERROR')
+    if hasattr(cups, name))
+
+
+def _checkPrintFiles():
+    """Return True if this pycups can be trusted to use printFiles().
+
+    pycups <= 1.9.74 can silently fail (without returning an error) in
+    printFiles(), which would lose the job.
+
+    """
+    try:
+        cups.require("1.9.75")
+    except (AttributeError, RuntimeError):
+        return False
+    return True
+
+# Whether cups.Connection.printFiles() can be used at all.
+_printFilesAvailable = cups is not None and _checkPrintFiles()
+
 
 class Handle:
     """Shared implementation of a handle that can send documents to a printer."""
@@ -153,6 +201,13 @@ class Handle:
 
 class CmdHandle(Handle):
     """Print a document using the `lp` shell command."""
+
+    #: Seconds to wait for the `lp` command to finish.
+    timeout = 300
+
+    #: The maximum number of bytes of the error output of `lp` to keep.
+    maxErrorLength = 4096
+
     def __init__(self, command, server="", port=0, user="", printer=None):
         self._command = command
         self._server = server
@@ -163,7 +218,7 @@ class CmdHandle(Handle):
     @classmethod
     def create(cls, printer=None, server="", port=0, user="", cmd="lp"):
         """Create a handle to print using a shell command, if available."""
-        cmd = shutil.which(cmd)
+        cmd = _which(cmd)
         if cmd:
             return cls(cmd, server, port, user, printer)
 
@@ -186,72 +241,174 @@ class CmdHandle(Handle):
             cmd.append('--')
         cmd.extend(filenames)
         try:
-            p = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stderr=subprocess.PIPE)
+            p = subprocess.run(cmd, stdin=subprocess.DEVNULL,
+                               stderr=subprocess.PIPE, timeout=self.timeout)
         except OSError as e:
             return e.errno, e.strerror
-        message = p.communicate()[1].decode('UTF-8', 'replace')
-        return p.wait(), message
+        except subprocess.TimeoutExpired:
+            return 1, "Timeout waiting for {0}".format(self._command)
+        message = p.stderr[:self.maxErrorLength].decode('UTF-8', 'replace')
+        return p.returncode, message
 
 
 class IppHandle(Handle):
     """Print a document using a connection to the CUPS server."""
-    def __init__(self, connection, printer=None):
+    def __init__(self, connection, printer=None, key=None):
         super().__init__(printer)
         self._connection = connection
+        self._key = key
 
     @classmethod
     def create(cls, printer=None, server="", port=0, user=""):
         """Return a handle to print using a connection to the (local) CUPS server, if available."""
-        try:
-            import cups
-        except ImportError:
+        if cups is None:
             return
-        cups.setServer(server or "")
-        cups.setPort(port or 0)
-        cups.setUser(user or "")
-        try:
-            c = cups.Connection()
-        except RuntimeError:
-            return
-        h = cls(c, printer)
-        if h.printer().printerName() in c.getPrinters():
-            return h
+        key = (server or "", port or 0, user or "")
+        c, names = _connection(*key)
+        if c:
+            h = cls(c, printer, key)
+            if h.printer().printerName() in names:
+                return h
 
     def _doPrintFiles(self, printerName, filenames, title, options):
-        """Print filenames using a connection to the CUPS server."""
-        import cups
-        # cups.Connection.printFiles() behaves flaky: version 1.9.74 can
+        """Print filenames using a connection to the CUPS server.
+
+        All files are sent in one job using printFiles(), if the installed
+        pycups is newer than 1.9.74 (older versions can silently fail).
+        If the server rejects the job with one of the known errors, which may
+        depend on the options, the files of this job are printed one by one.
+        A server that does not support the operation at all is remembered,
+        and later jobs to it are printed one by one right away.
+
+        If printing fails, the cached connection is dropped, so that handle()
+        makes a new connection for the next job.
+
+        """
+        try:
+            self._sendFiles(printerName, filenames, title, options)
+        except (cups.IPPError, RuntimeError) as err:
+            entry = _connections.get(self._key)
+            if entry and entry[0] is self._connection:
+                del _connections[self._key]
+            if isinstance(err, cups.IPPError):
+                return err.args
+            return 1, str(err)
+        return 0, ""
+
+    def _sendFiles(self, printerName, filenames, title, options):
+        """Send the files to the CUPS server, raising an exception on error."""
+        # cups.Connection.printFiles() behaves flaky: pycups <= 1.9.74 can
         # silently fail (without returning an error), and after having fixed
         # that, there are strange error messages on some options.
-        # Therefore we use cups.printFile() for every file.
-        for filename in filenames:
+        # In those cases we use cups.printFile() for every file.
+        if _printFilesAvailable and self._key not in _printFilesUnsupported:
             try:
-                self._connection.printFile(printerName, filename, title, options)
+                self._connection.printFiles(printerName, list(filenames), title, options)
             except cups.IPPError as err:
-                return err.args
-        return 0, ""
+                if err.args[0] not in _printFilesErrors:
+                    raise
+                if err.args[0] == getattr(cups, 'IPP_OPERATION_NOT_SUPPORTED', None):
+                    _printFilesUnsupported.add(self._key)
+            else:
+                return
+        for filename in filenames:
+            self._connection.printFile(printerName, filename, title, options)
+
+
+def _connection(server, port, user):
+    """Return a tuple (connection, printer names) for a CUPS server.
+
+    The connection is reused for the same server, port and user. The set of
+    printer names is only read again when it is older than
+    `connectionTimeout` seconds. If no connection can be made, (None, ())
+    is returned.
+
+    """
+    key = (server, port, user)
+    try:
+        c, t, names = _connections[key]
+    except KeyError:
+        pass
+    else:
+        if time.monotonic() - t < connectionTimeout:
+            return c, names
+        try:
+            names = set(c.getPrinters())
+        except (cups.IPPError, RuntimeError):
+            # the connection has become unusable, make a new one
+            del _connections[key]
+        else:
+            _connections[key] = (c, time.monotonic(), names)
+            return c, names
+    cups.setServer(server)
+    cups.setPort(port)
+    cups.setUser(user)
+    try:
+        c = cups.Connection()
+        names = set(c.getPrinters())
+    except (cups.IPPError, RuntimeError):
+        return None, ()
+    _connections[key] = (c, time.monotonic(), names)
+    return c, names
+
+
+@functools.lru_cache(maxsize=8)
+def _which(cmd):
+    """Return the full path of the command, caching the result."""
+    return shutil.which(cmd)
+
+
+def clearCache():
+    """Forget cached lookups, e.g. after the PATH has been modified.
+
+    The full path of the `lp` command is only looked up once, so a change of
+    the PATH environment variable is not noticed until this function is
+    called. Cached connections to CUPS servers are also dropped.
+
+    """
+    _which.cache_clear()
+    _connections.clear()
+    _noHandle.clear()
+    _printFilesUnsupported.clear()
 
 
 def handle(printer=None, server="", port=0, user=""):
-    """Return the first available handle to print a document to a CUPS server."""
-    return (IppHandle.create(printer, server, port, user) or
-            CmdHandle.create(printer, server, port, user))
+    """Return the first available handle to print a document to a CUPS server.
+
+    If no handle is available, that is remembered for `noHandleTimeout`
+    seconds, during which None is returned immediately for the same arguments.
+    Call clearCache() to try again earlier.
+
+    """
+    key = (printer.printerName() if printer is not None else None, server, port, user)
+    t = _noHandle.get(key)
+    if t is not None and time.monotonic() - t < noHandleTimeout:
+        return
+    h = (IppHandle.create(printer, server, port, user) or
+         CmdHandle.create(printer, server, port, user))
+    if h:
+        _noHandle.pop(key, None)
+    else:
+        _noHandle[key] = time.monotonic()
+    return h
 
 
 def options(printer):
     """Return the dict of CUPS options read from the QPrinter object."""
     o = {}
+    engine = printer.printEngine()
+    layout = printer.pageLayout()
 
     # cups options that can be set in QPrintDialog on unix
     # I found this in qt5/qtbase/src/printsupport/kernel/qcups.cpp.
     # Esp. options like page-set even/odd do make sense.
-    props = printer.printEngine().property(0xfe00)
+    props = engine.property(QPrintEngine.PrintEnginePropertyKey(0xfe00))
     if props and isinstance(props, list) and len(props) % 2 == 0:
         for key, value in zip(props[0::2], props[1::2]):
             if value and isinstance(key, str) and isinstance(value, str):
                 o[key] = value
 
-    o['copies'] = format(printer.copyCount())
+    o['copies'] = str(printer.copyCount())
     if printer.collateCopies():
         o['collate'] = 'true'
 
@@ -264,31 +421,32 @@ def options(printer):
         o['outputorder'] = 'reverse'
 
     # media size
-    media = []
-    size = printer.paperSize()
-    if size == QPrinter.ZoomMode.Custom:
-        media.append('Custom.{0}x{1}mm'.format(printer.heightMM(), printer.widthMM()))
-    elif size in PAGE_SIZES:
-        media.append(PAGE_SIZES[size])
+    size = layout.pageSize().id()
+    if size == QPageSize.PageSizeId.Custom:
+        media = 'Custom.{0}x{1}mm'.format(printer.heightMM(), printer.widthMM())
+    else:
+        i = size.value
+        media = _PAGE_SIZE_NAMES[i] if 0 <= i < len(_PAGE_SIZE_NAMES) else None
 
     # media source
-    source = printer.paperSource()
-    if source in PAPER_SOURCES:
-        media.append(PAPER_SOURCES[source])
+    i = printer.paperSource().value
+    source = _PAPER_SOURCE_NAMES[i] if 0 <= i < len(_PAPER_SOURCE_NAMES) else None
+    if source:
+        media = media + ',' + source if media else source
 
     if media:
-        o['media'] = ','.join(media)
+        o['media'] = media
 
     # page margins
-    if printer.printEngine().property(QPrintEngine.PrintEnginePropertyKey.PPK_PageMargins):
-        left, top, right, bottom = printer.getPageMargins(QPrinter.Unit.Point)
-        o['page-left'] = format(left)
-        o['page-top'] = format(top)
-        o['page-right'] = format(right)
-        o['page-bottom'] = format(bottom)
+    if engine.property(QPrintEngine.PrintEnginePropertyKey.PPK_PageMargins):
+        margins = layout.margins(QPageLayout.Unit.Point)
+        o['page-left'] = str(margins.left())
+        o['page-top'] = str(margins.top())
+        o['page-right'] = str(margins.right())
+        o['page-bottom'] = str(margins.bottom())
 
     # orientation
-    landscape = printer.orientation() == QPrinter.Landscape
+    landscape = layout.orientation() == QPageLayout.Orientation.Landscape
     if landscape:
         o['landscape'] = 'true'
 
@@ -384,3 +542,14 @@ PAPER_SOURCES = {
     QPrinter.PaperSource.SmallFormat: "SmallFormat",
 }
 
+
+def _byValue(d):
+    """Return a tuple with the values of dict d, indexed by the value of its enum keys."""
+    t = [None] * (max(k.value for k in d) + 1)
+    for k, v in d.items():
+        t[k.value] = v
+    return tuple(t)
+
+# PAGE_SIZES and PAPER_SOURCES for fast lookup by enum value in options()
+_PAGE_SIZE_NAMES = _byValue(PAGE_SIZES)
+_PAPER_SOURCE_NAMES = _byValue(PAPER_SOURCES)
@@ -25,12 +25,17 @@ PDF rendering backend using QtPdf.
 
 """
 
+import collections
 import contextlib
+import os
+import threading
 import weakref
 import platform
 
-from PyQt6.QtCore import Qt, QCoreApplication, QModelIndex, QRect, QRectF, QSize
-from PyQt6.QtGui import QPainter
+from PyQt6.QtCore import (
+    Qt, QBuffer, QByteArray, QCoreApplication, QIODevice, QModelIndex,
+    QRectF, QSize, QUrl)
+from PyQt6.QtGui import QImage, QPagedPaintDevice, QPainter
 from PyQt6.QtPdf import QPdfDocument, QPdfDocumentRenderOptions, QPdfLinkModel
 
 from . import document
@@ -40,63 +45,65 @@ from . import locking
 from . import render
 
 
-# store the links in the page of a Poppler document as long as the document exists
-_linkscache = weakref.WeakKeyDictionary()
+# local file URLs need some fixing on Windows, see Link
+_IS_WINDOWS = platform.system() == "Windows"
+
+# This ridiculous back-and-forth conversion is necessary because
+# PyQt6 won't let you just 'OR' together RenderFlag constants.
+_RenderFlag = QPdfDocumentRenderOptions.RenderFlag
+_ALIASED_FLAGS = _RenderFlag(
+    _RenderFlag.TextAliased.value
+    | _RenderFlag.ImageAliased.value
+    | _RenderFlag.PathAliased.value)
+_ANTIALIASED_FLAGS = _RenderFlag(0)
+
+# documents loaded from a file, by (path, mtime, size), to reuse them
+_fileDocuments = weakref.WeakValueDictionary()
+
+
+def _fixWindowsUrl(url):
+    """Fix weird things QUrl does to local paths on Windows."""
+    for proto in ("file", "textedit"):
+        scheme = "{0}://".format(proto)
+        pos = len(scheme) + 1  # the colon should be here
+        if (url.startswith(scheme)
+            and url[pos - 1].isalpha() and not url[pos].isalpha()):
+            # Capitalize the drive letter because that is the standard
+            # format, and some path-matching functions (incorrectly)
+            # assume case sensitivity
+            driveLetter = url[pos - 1].upper()
+            # Make sure there is a colon after the drive letter
+            if url[pos] != ":":
+                driveLetter = "{0}:".format(driveLetter)
+            path = url[pos:]
+            url = "".join((scheme, driveLetter, path))
+    return url
 
 
 class Link(link.Link):
     """A link that encapsulates QPdfLinkModel data."""
-    def __init__(self, linkobj, index, pointSize):
-        self.linkobj = linkobj
-        self.index = index
+    def __init__(self, linkobj, index, xscale, yscale):
         # Convert to relative coordinates between 0.0 and 1.0 as expected
-        # by link.Link, which uses them for compatibility with Poppler
+        # by link.Link, which uses them for compatibility with Poppler.
+        # xscale and yscale are 1 / the page width and height in points.
         rect = linkobj.data(index, QPdfLinkModel.Role.Rectangle.value)
         x1, y1, x2, y2 = rect.normalized().getCoords()
-        self.area = (x1 / pointSize.width(), y1 / pointSize.height(),
-                     x2 / pointSize.width(), y2 / pointSize.height())
+        self.area = (x1 * xscale, y1 * yscale, x2 * xscale, y2 * yscale)
+        # Copy the link data, so the link model needs not to be kept
+        url = linkobj.data(index, QPdfLinkModel.Role.Url.value).toString()
+        if _IS_WINDOWS:
+            url = _fixWindowsUrl(url)
+        self.url = url
+        self.isExternal = "://" in url
+        # QtPdf pages are 0-indexed, but our View is 1-indexed
+        page = linkobj.data(index, QPdfLinkModel.Role.Page.value)
+        self.targetPage = (page + 1) if page != -1 else -1
 
     @property
     def fileName(self):
         """The file name if this is an external link."""
         return QUrl(self.url).fileName() if self.isExternal else ""
 
-    @property
-    def isExternal(self):
-        """Indicates whether this is an external link."""
-        return (self.url and "://" in self.url)
-
-    @property
-    def targetPage(self):
-        """If this is an internal link, the page number to which the
-        link should jump; otherwise -1."""
-        # QtPdf pages are 0-indexed, but our View is 1-indexed
-        page = self.linkobj.data(self.index, QPdfLinkModel.Role.Page.value)
-        return (page + 1) if page != -1 else -1
-
-    @property
-    def url(self):
-        """The URL the link points to."""
-        url = self.linkobj.data(self.index,
-                                QPdfLinkModel.Role.Url.value).toString()
-        if platform.system() == "Windows":
-            # Fix weird things QUrl does to local paths
-            for proto in ("file", "textedit"):
-                scheme = "{0}://".format(proto)
-                pos = len(scheme) + 1  # the colon should be here
-                if (url.startswith(scheme)
-                    and url[pos - 1].isalpha() and not url[pos].isalpha()):
-                    # Capitalize the drive letter because that is the standard
-                    # format, and some path-matching functions (incorrectly)
-                    # assume case sensitivity
-                    driveLetter = url[pos - 1].upper()
-                    # Make sure there is a colon after the drive letter
-                    if url[pos] != ":":
-                        driveLetter = "{0}:".format(driveLetter)
-                    path = url[pos:]
-                    url = "".join((scheme, driveLetter, path))
-        return url
-
 
 class PdfPage(page.AbstractRenderedPage):
     """A Page capable of displaying one page of a QPdfDocument instance.
@@ -162,20 +169,12 @@ class PdfPage(page.AbstractRenderedPage):
     def links(self):
         """Return links inside the document."""
         document, pageNumber = self.document, self.pageNumber
-        try:
-            return _linkscache[document][pageNumber]
-        except KeyError:
+        # the links are stored on the document, as long as it exists
+        links = getattr(document, "_qpageview_links", None)
+        if links is None:
             with locking.lock(document):
-                lm = QPdfLinkModel(document=document, page=pageNumber)
-                parentIndex = QModelIndex()
-                links = []
-                for row in range(lm.rowCount(parentIndex)):
-                    index = lm.index(row, 0, parentIndex)
-                    links.append(Link(lm, index,
-                                      document.pagePointSize(pageNumber)))
-                links = link.Links(links)
-            _linkscache.setdefault(document, {})[pageNumber] = links
-            return links
+                links = document._qpageview_links = _loadLinks(document)
+        return links[pageNumber]
 
 
 class PdfDocument(document.SingleSourceDocument):
@@ -187,7 +186,14 @@ class PdfDocument(document.SingleSourceDocument):
         self._document = None
 
     def invalidate(self):
-        """Reimplemented to clear the Poppler Document reference."""
+        """Reimplemented to clear the QPdfDocument reference.
+
+        The file is then also really loaded again, even if it seems unchanged.
+
+        """
+        source = self.source()
+        if isinstance(source, str):
+            _forgetFile(source)
         super().invalidate()
         self._document = None
 
@@ -210,35 +216,112 @@ class PdfDocument(document.SingleSourceDocument):
         return self._document
 
 
+class PageImageCache:
+    """Keep the most recently rendered full page images.
+
+    QtPdf can only render full pages, so when a page is rendered in more than
+    one tile, the full page image is kept here and every tile is cropped from
+    it. The least recently used images are removed when the total size
+    exceeds maxsize bytes. Images larger than maxsize are not kept at all.
+
+    """
+    maxsize = 104857600 # 100M
+
+    def __init__(self):
+        self._images = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.currentsize = 0
+
+    def clear(self):
+        """Remove all cached images."""
+        with self._lock:
+            self._images.clear()
+            self.currentsize = 0
+
+    def invalidate(self, page):
+        """Remove all cached images of the page."""
+        with self._lock:
+            for key in list(self._images):
+                if key[0]() is page.document and key[1] == page.pageNumber:
+                    self.currentsize -= self._images.pop(key).sizeInBytes()
+
+    def get(self, key):
+        """Return the image for the key, or None."""
+        with self._lock:
+            image = self._images.get(key)
+            if image is not None:
+                self._images.move_to_end(key)
+            return image
+
+    def add(self, key, image):
+        """Store the image for the key, removing old images if needed."""
+        size = image.sizeInBytes()
+        with self._lock:
+            old = self._images.pop(key, None)
+            if old is not None:
+                self.currentsize -= old.sizeInBytes()
+            if size > self.maxsize:
+                return
+            self._images[key] = image
+            self.currentsize += size
+            while self.currentsize > self.maxsize:
+                old = self._images.popitem(last=False)[1]
+                self.currentsize -= old.sizeInBytes()
+
+
 class PdfRenderer(render.AbstractRenderer):
     oversampleThreshold = 96    # DPI of a standard PC screen
 
+    def invalidate(self, pages):
+        """Reimplemented to also delete the cached full page images."""
+        super().invalidate(pages)
+        for p in pages:
+            self.pageImageCache.invalidate(p)
+
     def tiles(self, width, height):
         """Yield four-tuples Tile(x, y, w, h) describing the tiles to render.
 
-        For the QtPdf backend, this always returns a single tile covering
-        the entire page because QtPdf does not support selectively rendering
-        a smaller area.
+        QtPdf can only render full pages, so every tile is cropped from the
+        full page image in the pageImageCache. If that image would take more
+        than a fair share of the cache, it could be pushed out before all
+        tiles are rendered, so then a single tile covering the entire page is
+        yielded.
 
         """
-        yield render.Tile(0, 0, width, height)
+        if self._cacheable(width, height):
+            yield from super().tiles(width, height)
+        else:
+            yield render.Tile(0, 0, width, height)
+
+    def _cacheable(self, width, height):
+        """Return True if a full page image of the given size can be cached.
+
+        That is, if it takes at most a quarter of the pageImageCache, so that
+        the images of some visible pages fit in the cache together.
+
+        """
+        return width * height * 4 <= self.pageImageCache.maxsize // 4
 
     def draw(self, page, painter, key, tile, paperColor=None):
         """Draw a tile on the painter.
 
         The painter is already at the right position and rotation.
 
+        QtPdf does not support selectively rendering a smaller area, so the
+        full page is rendered (or taken from the pageImageCache), and the
+        tile is cropped from it.
+
         """
-        pageSize = page.pageSize()  # in points
         # key and tile coordinates scale with device resolution and zoom level
         source = QRectF(0, 0, key.width, key.height)
-        target = QRectF(0, 0, tile.w, tile.h)
+        # page size in points
         if key.rotation & 1:
-            pageSize.transpose()
-            target.setSize(target.size().transposed())
+            pageWidth, pageHeight = page.pageHeight, page.pageWidth
+            target = QRectF(0, 0, tile.h, tile.w)
+        else:
+            pageWidth, pageHeight = page.pageWidth, page.pageHeight
+            target = QRectF(0, 0, tile.w, tile.h)
 
-        doc = page.document
-        num = page.pageNumber
         xres = painter.device().logicalDpiX()
         yres = painter.device().logicalDpiY()
 
@@ -258,24 +341,37 @@ class PdfRenderer(render.AbstractRenderer):
         if actualSize:
             # If our effective pixel density at this zoom level is below
             # our threshold, render at double size then downscale
-            xresEffective = 72.0 * key.width / pageSize.width()
-            yresEffective = 72.0 * key.height / pageSize.height()
+            xresEffective = 72.0 * key.width / pageWidth
+            yresEffective = 72.0 * key.height / pageHeight
             xMultiplier = 2 if xresEffective < self.oversampleThreshold else 1
             yMultiplier = 2 if yresEffective < self.oversampleThreshold else 1
         else:
             xMultiplier = 1
             yMultiplier = 1
 
+        # The full page image is only cached if the page is split in tiles,
+        # so that the other tiles can be cropped from it, and never when
+        # printing or exporting to PDF
+        cache = (not isinstance(painter.device(), QPagedPaintDevice)
+                 and len(list(self.tiles(key.width, key.height))) > 1)
+        if cache and not self._cacheable(
+                key.width * xMultiplier, key.height * yMultiplier):
+            # the full page image must fit in the pageImageCache,
+            # so do not oversample
+            xMultiplier = yMultiplier = 1
+
         # Render the image at the output device's resolution (or double
         # that if we are oversampling)
         s = matrix.scale(xMultiplier, yMultiplier).mapRect(source)
-        image = self._render_image(doc, num,
+        image = self._page_image(page,
             xres * xMultiplier, yres * yMultiplier,
-            int(s.width()), int(s.height()), paperColor)
+            int(s.width()), int(s.height()), paperColor, cache)
 
         if tile != (0, 0, key.width, key.height):
-            # Crop the image to the tile boundaries
-            image = image.copy(matrix.mapRect(QRect(*map(int, tile))))
+            # Crop the image to the tile boundaries, unless they cover it
+            crop = self.map(key, QRectF(image.rect())).mapRect(QRectF(*tile)).toRect()
+            if crop != image.rect():
+                image = image.copy(crop)
 
         if actualSize and QRectF(image.rect()) != target:
             # Scale the image to our requested resolution
@@ -287,6 +383,26 @@ class PdfRenderer(render.AbstractRenderer):
         painter.eraseRect(target)
         painter.drawImage(target, image, QRectF(image.rect()))
 
+    def _page_image(self, page, xres, yres, w, h, paperColor=None, cache=True):
+        """Return an image of the full page, from the pageImageCache if possible.
+
+        The document is only weakly referenced by the cache key, so images of
+        a deleted document are never returned, and are eventually pushed out.
+        If cache is False, the cache is not used.
+
+        """
+        if not cache:
+            return self._render_image(page.document, page.pageNumber,
+                                      xres, yres, w, h, paperColor)
+        key = (weakref.ref(page.document), page.pageNumber, w, h,
+               paperColor.rgba() if paperColor else None, self.antialiasing)
+        image = self.pageImageCache.get(key)
+        if image is None:
+            image = self._render_image(page.document, page.pageNumber,
+                                       xres, yres, w, h, paperColor)
+            self.pageImageCache.add(key, image)
+        return image
+
     def _render_image(self, doc, pageNum,
                       xres=72.0, yres=72.0, w=-1, h=-1, paperColor=None):
         """Render an image.
@@ -299,29 +415,26 @@ class PdfRenderer(render.AbstractRenderer):
         are set.
 
         """
-        RenderFlag = QPdfDocumentRenderOptions.RenderFlag
         with locking.lock(doc):
             options = QPdfDocumentRenderOptions()
-
-            # This ridiculous back-and-forth conversion is necessary because
-            # PyQt6 won't let you just 'OR' together RenderFlag constants.
-            renderFlags = 0
-            if not self.antialiasing:
-                renderFlags |= RenderFlag.TextAliased.value
-                renderFlags |= RenderFlag.ImageAliased.value
-                renderFlags |= RenderFlag.PathAliased.value
-            options.setRenderFlags(RenderFlag(renderFlags))
-
-            image = doc.render(pageNum, QSize(int(w), int(h)), options)
-            if paperColor:
-                # QtPdf leaves the page background transparent, so we need to
-                # paint it ourselves.
-                content = image.copy()
-                painter = QPainter(image)
-                painter.fillRect(image.rect(), paperColor)
-                painter.drawImage(0, 0, content)
-                painter.end()
-            return image
+            options.setRenderFlags(
+                _ANTIALIASED_FLAGS if self.antialiasing else _ALIASED_FLAGS)
+
+            renderedPage = doc.render(pageNum, QSize(int(w), int(h)), options)
+        if not paperColor or paperColor.alpha() == 0:
+            # nothing to composite
+            return renderedPage
+        # QtPdf leaves the page background transparent, so we need to
+        # paint it ourselves, behind the page contents. The rendered image
+        # is not shared, so we can paint on it directly.
+        painter = QPainter(renderedPage)
+        painter.setCompositionMode(QPainter.CompositionMode.CompositionMode_DestinationOver)
+        painter.fillRect(renderedPage.rect(), paperColor)
+        painter.end()
+        if paperColor.alpha() == 255:
+            # the page is opaque now, which makes drawing it faster
+            renderedPage.convertTo(QImage.Format.Format_RGB32)
+        return renderedPage
 
 
 def load(source):
@@ -334,14 +447,87 @@ def load(source):
 
     Returns None if the document could not be loaded.
 
+    If a file is loaded that was loaded before and did not change since then,
+    the same QPdfDocument is returned, if it still exists, e.g. when a new
+    PdfDocument is opened on the same file. PdfDocument.invalidate() forces
+    loading the file again.
+
     """
     if isinstance(source, QPdfDocument):
         return source
-    elif isinstance(source, str) or isinstance(source, QByteArray):
-        document = QPdfDocument(QCoreApplication.instance())
-        document.load(source)
+    elif isinstance(source, str):
+        key = _fileKey(source)
+        if key:
+            document = _fileDocuments.get(key)
+            if document is not None:
+                return document
+        document = _newDocument(source, QCoreApplication.instance())
+        if key:
+            _fileDocuments[key] = document
         return document
+    elif isinstance(source, QByteArray):
+        return _newDocument(source, QCoreApplication.instance())
+
+
+def _fileKey(filename):
+    """Return a tuple (path, mtime, size) identifying the file's contents.
 
+    Returns None if the file cannot be found.
+
+    """
+    path = os.path.realpath(filename)
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (path, st.st_mtime_ns, st.st_size)
+
+
+def _forgetFile(filename):
+    """Make load() really load the file again, the next time."""
+    path = os.path.realpath(filename)
+    for key in list(_fileDocuments.keys()):
+        if key[0] == path:
+            _fileDocuments.pop(key, None)
+
+
+def _newDocument(source, parent=None):
+    """Return a new QPdfDocument loaded from a filename or QByteArray."""
+    document = QPdfDocument(parent)
+    if isinstance(source, QByteArray):
+        buf = QBuffer(document)
+        buf.setData(source)
+        buf.open(QIODevice.OpenModeFlag.ReadOnly)
+        document.load(buf)
+    else:
+        document.load(source)
+    return document
+
+
+def _loadLinks(document):
+    """Return a list with the Links of all pages, indexed by page number.
+
+    One QPdfLinkModel is used for all pages of the QPdfDocument. The link
+    data is copied into the Link objects, so the model is not kept.
+
+    """
+    lm = QPdfLinkModel()
+    lm.setDocument(document)
+    parentIndex = QModelIndex()
+    result = []
+    for pageNumber in range(document.pageCount()):
+        lm.setPage(pageNumber)
+        pointSize = document.pagePointSize(pageNumber)
+        xscale = 1 / pointSize.width()
+        yscale = 1 / pointSize.height()
+        result.append(link.Links([
+            Link(lm, lm.index(row, 0, parentIndex), xscale, yscale)
+            for row in range(lm.rowCount(parentIndex))]))
+    return result
+
+
+# Install a cache for full page images, shared by all renderers by default
+PdfRenderer.pageImageCache = PageImageCache()
 
 # Install a default renderer so PdfPage can be used directly
 PdfPage.renderer = PdfRenderer()
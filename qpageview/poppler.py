@@ -222,13 +222,18 @@ class PopplerRenderer(render.AbstractRenderer):
 
         xres = 72.0 * key.width / s.width()
         yres = 72.0 * key.height / s.height()
-        multiplier = 2 if xres < self.oversampleThreshold else 1
+        # only oversample in the direction(s) where the resolution is low
+        xMultiplier = 2 if xres < self.oversampleThreshold else 1
+        yMultiplier = 2 if yres < self.oversampleThreshold else 1
         image = self.render_poppler_image(doc, num,
-            xres * multiplier, yres * multiplier,
-            tile.x * multiplier, tile.y * multiplier, tile.w * multiplier, tile.h * multiplier,
+            xres * xMultiplier, yres * yMultiplier,
+            tile.x * xMultiplier, tile.y * yMultiplier,
+            tile.w * xMultiplier, tile.h * yMultiplier,
             key.rotation, paperColor)
-        if multiplier == 2:
-            image = image.scaledToWidth(tile.w, Qt.TransformationMode.SmoothTransformation)
+        if xMultiplier > 1 or yMultiplier > 1:
+            image = image.scaled(tile.w, tile.h,
+                Qt.AspectRatioMode.IgnoreAspectRatio,
+                Qt.TransformationMode.SmoothTransformation)
         image.setDotsPerMeterX(int(xres * 39.37))
         image.setDotsPerMeterY(int(yres * 39.37))
         return image
@@ -249,7 +254,9 @@ class PopplerRenderer(render.AbstractRenderer):
             oldhints = int(doc.renderHints())
             doc.setRenderHint(oldhints, False)
             self.setRenderHints(doc)
-            if paperColor is not None:
+            # only touch the paper color if it is different
+            setcolor = paperColor is not None and paperColor != doc.paperColor()
+            if setcolor:
                 oldcolor = doc.paperColor()
                 doc.setPaperColor(paperColor)
             try:
@@ -259,7 +266,7 @@ class PopplerRenderer(render.AbstractRenderer):
                     doc.setRenderBackend(oldbackend)
                 doc.setRenderHint(int(doc.renderHints()), False)
                 doc.setRenderHint(oldhints)
-                if paperColor is not None:
+                if setcolor:
                     doc.setPaperColor(oldcolor)
 
     def render_poppler_image(self, doc, pageNum,
@@ -284,9 +291,10 @@ class PopplerRenderer(render.AbstractRenderer):
 
         """
         source = self.map(key, page.pageRect()).mapRect(QRectF(*tile)).toRect()   # rounded
-        target = QRectF(0, 0, tile.w, tile.h)
         if key.rotation & 1:
-            target.setSize(target.size().transposed())
+            target = QRectF(0, 0, tile.h, tile.w)
+        else:
+            target = QRectF(0, 0, tile.w, tile.h)
 
         doc = page.document
         p = doc.page(page.pageNumber)
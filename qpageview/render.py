@@ -397,13 +397,17 @@ class AbstractRenderer:
         job.mutex = page.mutex()
         exception = []
         def work():
+            if not callbacks:
+                # unscheduled before the work started: the image is not needed
+                return None
             try:
                 return self.render(page, key, tile)
             except Exception:
                 exception.extend(sys.exc_info())
                 return QImage()
         def finalize(image):
-            self.cache.addtile(key, tile, image)
+            if image is not None:
+                self.cache.addtile(key, tile, image)
             for cb in callbacks:
                 cb(page)
             del _jobs[(key, tile)]
@@ -418,7 +422,8 @@ class AbstractRenderer:
         """Unschedule a possible pending rendering job for the given pages.
 
         If the pending job has no other callbacks left, it is removed,
-        unless it is running.
+        unless it is running. A running job without callbacks that did not
+        actually start rendering yet, skips the rendering.
 
         """
         pages = set((p.group(), p.ident()) for p in pages)